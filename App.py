@@ -2,91 +2,392 @@
 import streamlit as st
 import pandas as pd
 import zipfile
-from io import BytesIO
+from io import BytesIO, StringIO
+import numpy as np
 import os
+import math
+import time
+import json
+import tracemalloc
+import threading
+import cProfile
+import pstats
+import marshal
+import hmac
+import sqlite3
+import shutil
+import tempfile
+from datetime import date
+from contextlib import contextmanager
 import openpyxl
+from openpyxl.utils import get_column_letter
 from openpyxl.utils.dataframe import dataframe_to_rows
 
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
 # Set page title and layout
 st.set_page_config(page_title="NTSL Data Processor", layout="wide")
 
+# Streamlit runs every session in its own thread of one process. The stage metrics and the
+# stack of open stages are kept per thread, so one session's stages never land in another's
+# run. tracemalloc is process-wide, so only one session at a time may collect metrics; its
+# memory peaks still include allocations made by other sessions running alongside it.
+metrics_state = threading.local()
+metrics_lock = threading.Lock()
+
+def start_run_metrics():
+    # Returns False when another session is already collecting metrics
+    if not metrics_lock.acquire(blocking=False):
+        return False
+    metrics_state.run_metrics = []
+    metrics_state.open_stages = []
+    tracemalloc.start()
+    return True
+
+def stop_run_metrics():
+    metrics = getattr(metrics_state, "run_metrics", None)
+    if metrics is None:
+        return None
+    metrics_state.run_metrics = None
+    tracemalloc.stop()
+    metrics_lock.release()
+    return metrics
+
+def process_peak_rss_kb():
+    # High-water mark for the whole process so far, not a per-stage peak
+    if resource is None:
+        return None
+    # ru_maxrss is reported in kilobytes on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if os.uname().sysname == "Darwin" else peak
+
+@contextmanager
+def stage(name, **details):
+    # Record wall time, CPU time, rows and peak memory for a block of work.
+    # Callers may set details["rows"] on the yielded dict.
+    run_metrics = getattr(metrics_state, "run_metrics", None)
+    if run_metrics is None:
+        yield details
+        return
+    open_stages = metrics_state.open_stages
+
+    # Fold the peak seen so far into the enclosing stage before resetting it
+    if open_stages:
+        open_stages[-1]["child_peak"] = max(open_stages[-1]["child_peak"], tracemalloc.get_traced_memory()[1])
+    tracemalloc.reset_peak()
+    frame = {"child_peak": 0}
+    open_stages.append(frame)
+
+    wall_start = time.perf_counter()
+    cpu_start = time.thread_time()
+    try:
+        yield details
+    finally:
+        wall_seconds = time.perf_counter() - wall_start
+        cpu_seconds = time.thread_time() - cpu_start
+        open_stages.pop()
+        peak = max(frame["child_peak"], tracemalloc.get_traced_memory()[1])
+        if open_stages:
+            open_stages[-1]["child_peak"] = max(open_stages[-1]["child_peak"], peak)
+        run_metrics.append({
+            "stage": name,
+            **details,
+            "wall_seconds": round(wall_seconds, 4),
+            "cpu_seconds": round(cpu_seconds, 4),
+            "peak_traced_bytes": peak,
+            "process_peak_rss_kb": process_peak_rss_kb()
+        })
+
+@contextmanager
+def excel_writer(output_file):
+    # pd.ExcelWriter whose final openpyxl save is recorded as a stage of its own
+    writer = pd.ExcelWriter(output_file, engine='openpyxl')
+    try:
+        yield writer
+    finally:
+        with stage("workbook save", file=os.path.basename(output_file)):
+            writer.close()
+
+def profiling_requested():
+    # Admin toggle: NTSL_PROFILE=1 profiles every run. The ?profile=<token> URL parameter
+    # only works when NTSL_PROFILE_TOKEN is set on the server and the token matches.
+    if os.environ.get("NTSL_PROFILE", "").lower() in ("1", "true", "yes"):
+        return True
+    token = os.environ.get("NTSL_PROFILE_TOKEN", "")
+    requested = st.query_params.get("profile", "")
+    return bool(token) and hmac.compare_digest(requested.encode(), token.encode())
+
+def render_profile_summary(stats):
+    stream = StringIO()
+    stats.stream = stream
+    stream.write("Top functions by cumulative time\n")
+    stats.sort_stats("cumulative").print_stats(40)
+    stream.write("\nTop functions by own time\n")
+    stats.sort_stats("tottime").print_stats(25)
+    stream.write("\nCall tree (callees of the slowest functions)\n")
+    stats.sort_stats("cumulative").print_callees(15)
+    return stream.getvalue()
+
+def run_profiled(func, *args):
+    # Run func under cProfile and return func's result with the profile, kept in memory
+    # as a pstats dump (the same marshal format Profile.dump_stats writes) and a text summary
+    profiler = cProfile.Profile()
+    completed = False
+    try:
+        result = profiler.runcall(func, *args)
+        completed = True
+    finally:
+        profiler.create_stats()
+        profile = {
+            "pstats": marshal.dumps(profiler.stats),
+            "summary": render_profile_summary(pstats.Stats(profiler))
+        }
+
+        # A failed run returns nothing, so show what was captured before it failed
+        if not completed:
+            show_profile(profile)
+    return result, profile
+
+def show_profile(profile):
+    with st.expander("Profile", expanded=False):
+        st.text(profile["summary"][:5000])
+        col1, col2 = st.columns(2)
+        with col1:
+            st.download_button(
+                label="Download Profile (pstats)",
+                data=profile["pstats"],
+                file_name="run_profile.pstats",
+                mime="application/octet-stream"
+            )
+        with col2:
+            st.download_button(
+                label="Download Profile Summary",
+                data=profile["summary"],
+                file_name="run_profile.txt",
+                mime="text/plain"
+            )
+
+def show_run_metrics(metrics):
+    with st.expander("Run metrics", expanded=False):
+        table = pd.DataFrame(metrics)
+        # Totals per stage first, e.g. all combined re-reads against all combined writes
+        summary = table.groupby("stage", sort=False).agg(
+            count=("stage", "size"),
+            wall_seconds=("wall_seconds", "sum"),
+            cpu_seconds=("cpu_seconds", "sum"),
+            peak_traced_bytes=("peak_traced_bytes", "max")
+        )
+        st.dataframe(summary)
+        st.dataframe(table)
+        st.download_button(
+            label="Download Run Metrics",
+            data=json.dumps(metrics, indent=2, default=str),
+            file_name="run_metrics.json",
+            mime="application/json"
+        )
+
 def main():
     st.title("NTSL Data Processing Tool")
     
     # File upload section
     st.header("Step 1: Upload ZIP File")
     uploaded_file = st.file_uploader("Upload your NTSL ZIP file", type="zip")
+    collect_metrics = st.checkbox(
+        "Collect run metrics",
+        value=os.environ.get("NTSL_RUN_METRICS", "").lower() in ("1", "true", "yes")
+    )
     
     if uploaded_file is not None:
+        # Widget changes rerun the script; only process an upload once and render the
+        # cached results on every rerun
+        run_key = (getattr(uploaded_file, "file_id", None) or uploaded_file.name, uploaded_file.size)
+        if st.session_state.get("processed_run") != run_key:
+            st.session_state.pop("processed_run", None)
+            st.session_state["run_results"] = process_upload(uploaded_file, collect_metrics)
+            st.session_state["processed_run"] = run_key
+
+        results = st.session_state["run_results"]
+        show_run_results(results)
+        show_save_aggregates(results["cycle_aggregates"])
+        show_data_explorer(results["explorer"])
+
+    show_rollup_report()
+
+def process_upload(uploaded_file, collect_metrics):
+    # Run every step in a working directory of its own and keep everything the page shows
+    # afterwards, so reruns can render it again without touching shared files
+    run_dir = tempfile.mkdtemp(prefix="ntsl_run_")
+    profile = None
+    collecting = collect_metrics and start_run_metrics()
+    if collect_metrics and not collecting:
+        st.info("Another session is collecting run metrics; this run is not instrumented.")
+    try:
         with st.spinner("Processing files..."):
             # Process the uploaded file through all steps
-            process_all_steps(uploaded_file)
+            if profiling_requested():
+                results, profile = run_profiled(process_all_steps, uploaded_file, run_dir)
+            else:
+                results = process_all_steps(uploaded_file, run_dir)
+    finally:
+        metrics = stop_run_metrics() if collecting else None
+        shutil.rmtree(run_dir, ignore_errors=True)
 
-def process_all_steps(uploaded_file):
+    results["metrics"] = metrics
+    results["profile"] = profile
+    return results
+
+def process_all_steps(uploaded_file, run_dir="."):
     # Step 1: Process the ZIP file
-    combined_data_path = "combined_data.xlsx"
-    filter_zip_excel_data(uploaded_file, combined_data_path)
+    combined_data_path = os.path.join(run_dir, "combined_data.xlsx")
+    with stage("filter_zip_excel_data"):
+        cycle_names = filter_zip_excel_data(uploaded_file, combined_data_path)
     
     # Step 2: Clean descriptions
-    output_file_path = "output_file.xlsx"
-    process_excel_file(combined_data_path, output_file_path)
+    output_file_path = os.path.join(run_dir, "output_file.xlsx")
+    with stage("process_excel_file"):
+        process_excel_file(combined_data_path, output_file_path)
     
     # Step 3: Process the cleaned data
-    combined_output_path = "combined_output.xlsx"
-    process_combined_output(output_file_path, combined_output_path)
+    combined_output_path = os.path.join(run_dir, "combined_output.xlsx")
+    with stage("process_combined_output"):
+        start = time.perf_counter()
+        resolve_engine("combined")(output_file_path, combined_output_path)
+        combined_seconds = time.perf_counter() - start
     
     # Step 4: Aggregate the data
-    combined_aggregated_path = "combined_aggregated_output.xlsx"
-    process_aggregated_output(output_file_path, combined_aggregated_path)
-    
-    # Display download buttons
+    combined_aggregated_path = os.path.join(run_dir, "combined_aggregated_output.xlsx")
+    with stage("process_aggregated_output"):
+        sheets, cycle_aggregates = process_aggregated_output(output_file_path, combined_aggregated_path)
+
+    # Store cycles under their ZIP member name rather than the positional sheet name
+    cycle_aggregates["Cycle"] = cycle_aggregates["Cycle"].map(cycle_names).fillna(cycle_aggregates["Cycle"])
+
+    # Step 5: Build the drill-down table from the sheets loaded in step 4
+    with stage("build_explorer_table"):
+        explorer = build_explorer_table(sheets)
+
+    # Optionally run the other engine on the same input and compare against the real output
+    shadow_reports = None
+    if shadow_mode_enabled():
+        with stage("shadow comparison"):
+            shadow_reports = run_shadow_checks(output_file_path, {"combined": (combined_output_path, combined_seconds)})
+
+    with open(combined_output_path, "rb") as f:
+        combined_output = f.read()
+    with open(combined_aggregated_path, "rb") as f:
+        combined_aggregated = f.read()
+
+    return {
+        "combined_output": combined_output,
+        "combined_aggregated": combined_aggregated,
+        "explorer": explorer,
+        "cycle_aggregates": cycle_aggregates,
+        "shadow": shadow_reports
+    }
+
+def show_run_results(results):
     st.success("Processing complete!")
-    
+    show_downloads(results["combined_output"], results["combined_aggregated"])
+
+    if results["shadow"]:
+        show_shadow_report(results["shadow"])
+    if results["metrics"]:
+        show_run_metrics(results["metrics"])
+    if results["profile"]:
+        show_profile(results["profile"])
+
+def show_downloads(combined_output, combined_aggregated):
     col1, col2 = st.columns(2)
     with col1:
-        with open(combined_output_path, "rb") as f:
-            st.download_button(
-                label="Download Combined Output",
-                data=f,
-                file_name="combined_output.xlsx",
-                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-            )
+        st.download_button(
+            label="Download Combined Output",
+            data=combined_output,
+            file_name="combined_output.xlsx",
+            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+        )
     
     with col2:
-        with open(combined_aggregated_path, "rb") as f:
-            st.download_button(
-                label="Download Aggregated Output",
-                data=f,
-                file_name="combined_aggregated_output.xlsx",
-                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-            )
+        st.download_button(
+            label="Download Aggregated Output",
+            data=combined_aggregated,
+            file_name="combined_aggregated_output.xlsx",
+            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+        )
+
+def env_number(name, default):
+    # Fall back to the default rather than failing at startup on a malformed value
+    try:
+        value = float(os.environ.get(name, default))
+    except ValueError:
+        return default
+    # Reject inf/nan as well, which would overflow the int() conversions below
+    return value if math.isfinite(value) and value > 0 else default
+
+# Upload limits, checked against the ZIP central directory before any member is parsed.
+# The upload itself is held in memory by Streamlit and is capped by server.maxUploadSize.
+megabyte = 1024 * 1024
+max_zip_members = int(env_number("NTSL_MAX_ZIP_MEMBERS", 2000))
+max_member_size = int(env_number("NTSL_MAX_MEMBER_MB", 50) * megabyte)
+max_total_size = int(env_number("NTSL_MAX_TOTAL_MB", 1024) * megabyte)
+max_compression_ratio = env_number("NTSL_MAX_COMPRESSION_RATIO", 100)
+
+def prescan_zip(zip_ref):
+    # Return the .xls members and their total uncompressed size, or a reason to reject the archive
+    members = [info for info in zip_ref.infolist() if info.filename.endswith('.xls') and not info.is_dir()]
+    if len(members) > max_zip_members:
+        return None, 0, f"The ZIP contains {len(members)} .xls files; the limit is {max_zip_members}."
+
+    total_size = 0
+    for info in members:
+        if info.file_size > max_member_size:
+            return None, 0, f"{info.filename} is {info.file_size / megabyte:.1f} MB uncompressed; the limit is {max_member_size / megabyte:g} MB."
+        if info.compress_size and info.file_size / info.compress_size > max_compression_ratio:
+            return None, 0, f"{info.filename} has a compression ratio above {max_compression_ratio:g}:1."
+        total_size += info.file_size
+
+    if total_size > max_total_size:
+        return None, 0, f"The .xls files total {total_size / megabyte:.1f} MB uncompressed; the limit is {max_total_size / megabyte:g} MB."
+    return members, total_size, None
 
 def filter_zip_excel_data(zip_file, output_file):
-    # Create a new Excel writer to save filtered data into different sheets
-    with pd.ExcelWriter(output_file, engine='openpyxl') as writer:
-        # Open the ZIP file
-        with zipfile.ZipFile(zip_file, 'r') as zip_ref:
-            # List all files in the zip archive
-            extracted_files = [f for f in zip_ref.namelist() if f.endswith('.xls')]
-
-            # List to store the dataframes
+    # Open the ZIP file and check it before writing anything
+    with zipfile.ZipFile(zip_file, 'r') as zip_ref:
+        with stage("zip prescan"):
+            members, total_size, error = prescan_zip(zip_ref)
+        if error:
+            st.error(f"Upload rejected: {error}")
+            st.stop()
+        st.caption(f"{len(members)} .xls files, {total_size / megabyte:.1f} MB to process")
+
+        # Create a new Excel writer to save filtered data into different sheets
+        with excel_writer(output_file) as writer:
+            # List to store the dataframes, and the ZIP member behind each output sheet
             dfs = []
+            cycle_names = {}
             progress_bar = st.progress(0)
-            total_files = len(extracted_files)
-
-            # Process each file
-            for i, file in enumerate(extracted_files, start=1):
-                progress_bar.progress(i / total_files)
-                with zip_ref.open(file) as file_data:
+            processed_size = 0
+
+            # Process each file, reporting progress by uncompressed size
+            for info in members:
+                file = info.filename
+                progress_bar.progress(processed_size / total_size if total_size else 0.0)
+                processed_size += info.file_size
+                with zip_ref.open(info) as file_data:
                     # Read the excel file from the ZIP stream
-                    df = pd.read_excel(file_data, header=None)
+                    with stage("xls parse", member=file) as metrics:
+                        df = pd.read_excel(file_data, header=None)
+                        metrics["rows"] = len(df)
 
                     # Find the row index where the required headers exist
                     header_row_index = None
-                    for row_index, row in df.iterrows():
-                        if 'Description' in row.values and 'No of Txns' in row.values and 'Debit' in row.values and 'Credit' in row.values:
-                            header_row_index = row_index
-                            break
+                    with stage("header detection", member=file):
+                        for row_index, row in df.iterrows():
+                            if 'Description' in row.values and 'No of Txns' in row.values and 'Debit' in row.values and 'Credit' in row.values:
+                                header_row_index = row_index
+                                break
 
                     if header_row_index is None:
                         st.warning(f"Headers not found in {file}. Skipping.")
@@ -104,8 +405,10 @@ def filter_zip_excel_data(zip_file, output_file):
                         st.warning(f"No valid data in {file}. Skipping.")
                         continue
 
-                    # Add the dataframe to the list
-                    dfs.append(df)
+                    # Add the dataframe to the list, with the member it came from
+                    dfs.append((file, df))
+
+            progress_bar.progress(1.0)
 
             # Move the first sheet to the last position
             if dfs:
@@ -113,11 +416,15 @@ def filter_zip_excel_data(zip_file, output_file):
                 dfs.append(first_sheet)
 
                 # Write to the Excel file with adjusted sheet order
-                for i, df in enumerate(dfs, start=1):
-                    sheet_name = f"sheet{i}"
-                    df.to_excel(writer, sheet_name=sheet_name, index=False)
+                with stage("write combined data", rows=sum(len(df) for _, df in dfs)):
+                    for i, (file, df) in enumerate(dfs, start=1):
+                        sheet_name = f"sheet{i}"
+                        df.to_excel(writer, sheet_name=sheet_name, index=False)
+                        # Identify the cycle by its member path, without the extension
+                        cycle_names[sheet_name] = os.path.splitext(file)[0]
 
     st.success(f"Data from all Excel files has been saved to {output_file}")
+    return cycle_names
 
 # Define the suffixes you want to remove
 suffixes = [" - CC", " - CC -Paid", " - CC -Received"]
@@ -157,7 +464,7 @@ def process_excel_file(input_file, output_file):
     xl = pd.ExcelFile(input_file)
 
     # Prepare to write to output file
-    with pd.ExcelWriter(output_file, engine='openpyxl') as writer:
+    with excel_writer(output_file) as writer:
         # Iterate through each sheet
         sheet_names = xl.sheet_names
         progress_bar = st.progress(0)
@@ -168,15 +475,18 @@ def process_excel_file(input_file, output_file):
             # st.write(f"Processing sheet: {sheet_name}")
 
             # Load the sheet into a DataFrame
-            df = xl.parse(sheet_name)
+            with stage("sheet read", sheet=sheet_name):
+                df = xl.parse(sheet_name)
 
             # Ensure that the column you're processing is named 'Description' (case-sensitive)
             if 'Description' in df.columns:
                 # Apply the clean_description function to each row in the 'Description' column
-                df['Description'] = df['Description'].apply(clean_description)
+                with stage("clean_description", sheet=sheet_name, rows=len(df)):
+                    df['Description'] = df['Description'].apply(clean_description)
 
             # Save the updated DataFrame back to the same sheet in the output Excel file
-            df.to_excel(writer, sheet_name=sheet_name, index=False)
+            with stage("sheet write", sheet=sheet_name):
+                df.to_excel(writer, sheet_name=sheet_name, index=False)
 
     st.success(f"Processing complete. The modified file is saved as {output_file}.")
 
@@ -211,17 +521,19 @@ def process_excel_file(input_file, output_file):
 
 def process_combined_output(file_path, output_file):
     # Create an Excel writer object
-    with pd.ExcelWriter(output_file, engine='openpyxl') as writer:
+    with excel_writer(output_file) as writer:
         # Code 1 - Part 1
         results_1 = []
-        excel_sheets = pd.ExcelFile(file_path).sheet_names
+        with stage("combined sheet list"):
+            excel_sheets = pd.ExcelFile(file_path).sheet_names
 
         progress_bar = st.progress(0)
         total_sheets = len(excel_sheets)
 
         for i, sheet_name in enumerate(excel_sheets):
             progress_bar.progress((i + 1) / total_sheets)
-            df = pd.read_excel(file_path, sheet_name=sheet_name)
+            with stage("combined re-read", section="Beneficiary Approved Transaction Amount U3", sheet=sheet_name):
+                df = pd.read_excel(file_path, sheet_name=sheet_name)
             filtered_rows = df[df['Description'].str.startswith('Beneficiary', na=False) &
                                (df['Description'].str.endswith('Approved Transaction Amount', na=False) |
                                 df['Description'].str.endswith('U3 RB Approved Transaction Amount', na=False))]
@@ -236,7 +548,8 @@ def process_combined_output(file_path, output_file):
             results_1.append(new_row)
 
         output_df_1 = pd.DataFrame(results_1)
-        output_df_1.to_excel(writer, index=False, sheet_name="Combined", startrow=0)
+        with stage("combined write", section="Beneficiary Approved Transaction Amount U3"):
+            output_df_1.to_excel(writer, index=False, sheet_name="Combined", startrow=0)
         
         # Get the sheet object to append more data
         workbook = writer.book
@@ -249,7 +562,8 @@ def process_combined_output(file_path, output_file):
         # Beneficiary U2 Approved Transaction Amount
         results_21 = []
         for sheet_name in excel_sheets:
-            df = pd.read_excel(file_path, sheet_name=sheet_name)
+            with stage("combined re-read", section="Beneficiary U2 Approved Transaction Amount", sheet=sheet_name):
+                df = pd.read_excel(file_path, sheet_name=sheet_name)
             if not all(col in df.columns for col in ['Description', 'No of Txns', 'Debit', 'Credit']):
                 continue
             filtered_df = df[df['Description'].str.startswith('Beneficiary', na=False) &
@@ -263,8 +577,9 @@ def process_combined_output(file_path, output_file):
                     'Credit': filtered_df['Credit'].sum()
                 })
         output_df_21 = pd.DataFrame(results_21)
-        for r in dataframe_to_rows(output_df_21, index=False, header=True):
-            sheet.append(r)
+        with stage("combined write", section="Beneficiary U2 Approved Transaction Amount"):
+            for r in dataframe_to_rows(output_df_21, index=False, header=True):
+                sheet.append(r)
 
         # Add blank rows (6 lines)
         for _ in range(6):
@@ -273,7 +588,8 @@ def process_combined_output(file_path, output_file):
         # Beneficiary U2 RB Approved Transaction Amount
         results_22 = []
         for sheet_name in excel_sheets:
-            df = pd.read_excel(file_path, sheet_name=sheet_name)
+            with stage("combined re-read", section="Beneficiary U2 RB Approved Transaction Amount", sheet=sheet_name):
+                df = pd.read_excel(file_path, sheet_name=sheet_name)
             if not all(col in df.columns for col in ['Description', 'No of Txns', 'Debit', 'Credit']):
                 continue
             filtered_df = df[df['Description'].str.startswith('Beneficiary', na=False) &
@@ -287,8 +603,9 @@ def process_combined_output(file_path, output_file):
                     'Credit': filtered_df['Credit'].sum()
                 })
         output_df_22 = pd.DataFrame(results_22)
-        for r in dataframe_to_rows(output_df_22, index=False, header=True):
-            sheet.append(r)
+        with stage("combined write", section="Beneficiary U2 RB Approved Transaction Amount"):
+            for r in dataframe_to_rows(output_df_22, index=False, header=True):
+                sheet.append(r)
 
         # Add blank rows (6 lines)
         for _ in range(6):
@@ -297,7 +614,8 @@ def process_combined_output(file_path, output_file):
         # Beneficiary U3 Approved Transaction Amount
         results_23 = []
         for sheet_name in excel_sheets:
-            df = pd.read_excel(file_path, sheet_name=sheet_name)
+            with stage("combined re-read", section="Beneficiary U3 Approved Transaction Amount", sheet=sheet_name):
+                df = pd.read_excel(file_path, sheet_name=sheet_name)
             if not all(col in df.columns for col in ['Description', 'No of Txns', 'Debit', 'Credit']):
                 continue
             filtered_df = df[df['Description'].str.startswith('Beneficiary', na=False) &
@@ -311,8 +629,9 @@ def process_combined_output(file_path, output_file):
                     'Credit': filtered_df['Credit'].sum()
                 })
         output_df_23 = pd.DataFrame(results_23)
-        for r in dataframe_to_rows(output_df_23, index=False, header=True):
-            sheet.append(r)
+        with stage("combined write", section="Beneficiary U3 Approved Transaction Amount"):
+            for r in dataframe_to_rows(output_df_23, index=False, header=True):
+                sheet.append(r)
 
         # Add blank rows (6 lines)
         for _ in range(6):
@@ -321,7 +640,8 @@ def process_combined_output(file_path, output_file):
         # Beneficiary U3 RB Approved Transaction Amount
         results_24 = []
         for sheet_name in excel_sheets:
-            df = pd.read_excel(file_path, sheet_name=sheet_name)
+            with stage("combined re-read", section="Beneficiary U3 RB Approved Transaction Amount", sheet=sheet_name):
+                df = pd.read_excel(file_path, sheet_name=sheet_name)
             if not all(col in df.columns for col in ['Description', 'No of Txns', 'Debit', 'Credit']):
                 continue
             filtered_df = df[df['Description'].str.startswith('Beneficiary', na=False) &
@@ -335,8 +655,9 @@ def process_combined_output(file_path, output_file):
                     'Credit': filtered_df['Credit'].sum()
                 })
         output_df_24 = pd.DataFrame(results_24)
-        for r in dataframe_to_rows(output_df_24, index=False, header=True):
-            sheet.append(r)
+        with stage("combined write", section="Beneficiary U3 RB Approved Transaction Amount"):
+            for r in dataframe_to_rows(output_df_24, index=False, header=True):
+                sheet.append(r)
 
         # Add blank rows (6 lines)
         for _ in range(6):
@@ -345,7 +666,8 @@ def process_combined_output(file_path, output_file):
         # Remitter Approved Transaction Amount
         results_2 = []
         for sheet_name in excel_sheets:
-            df = pd.read_excel(file_path, sheet_name=sheet_name)
+            with stage("combined re-read", section="Remitter Approved Transaction Amount", sheet=sheet_name):
+                df = pd.read_excel(file_path, sheet_name=sheet_name)
             if not all(col in df.columns for col in ['Description', 'No of Txns', 'Debit', 'Credit']):
                 continue
             filtered_df = df[df['Description'].str.startswith('Remitter', na=False) &
@@ -359,8 +681,9 @@ def process_combined_output(file_path, output_file):
                     'Credit': filtered_df['Credit'].sum()
                 })
         output_df_2 = pd.DataFrame(results_2)
-        for r in dataframe_to_rows(output_df_2, index=False, header=True):
-            sheet.append(r)
+        with stage("combined write", section="Remitter Approved Transaction Amount"):
+            for r in dataframe_to_rows(output_df_2, index=False, header=True):
+                sheet.append(r)
 
         # Add blank rows (6 lines)
         for _ in range(6):
@@ -369,7 +692,8 @@ def process_combined_output(file_path, output_file):
         # Remitter U2 Approved Transaction Amount
         results_28 = []
         for sheet_name in excel_sheets:
-            df = pd.read_excel(file_path, sheet_name=sheet_name)
+            with stage("combined re-read", section="Remitter U2 Approved Transaction Amount", sheet=sheet_name):
+                df = pd.read_excel(file_path, sheet_name=sheet_name)
             if not all(col in df.columns for col in ['Description', 'No of Txns', 'Debit', 'Credit']):
                 continue
             filtered_df = df[df['Description'].str.startswith('Remitter', na=False) &
@@ -383,8 +707,9 @@ def process_combined_output(file_path, output_file):
                     'Credit': filtered_df['Credit'].sum()
                 })
         output_df_28 = pd.DataFrame(results_28)
-        for r in dataframe_to_rows(output_df_28, index=False, header=True):
-            sheet.append(r)
+        with stage("combined write", section="Remitter U2 Approved Transaction Amount"):
+            for r in dataframe_to_rows(output_df_28, index=False, header=True):
+                sheet.append(r)
 
         # Add blank rows (6 lines)
         for _ in range(6):
@@ -393,7 +718,8 @@ def process_combined_output(file_path, output_file):
         # Remitter U2 RB Approved Transaction Amount
         results_29 = []
         for sheet_name in excel_sheets:
-            df = pd.read_excel(file_path, sheet_name=sheet_name)
+            with stage("combined re-read", section="Remitter U2 RB Approved Transaction Amount", sheet=sheet_name):
+                df = pd.read_excel(file_path, sheet_name=sheet_name)
             if not all(col in df.columns for col in ['Description', 'No of Txns', 'Debit', 'Credit']):
                 continue
             filtered_df = df[df['Description'].str.startswith('Remitter', na=False) &
@@ -407,8 +733,9 @@ def process_combined_output(file_path, output_file):
                     'Credit': filtered_df['Credit'].sum()
                 })
         output_df_29 = pd.DataFrame(results_29)
-        for r in dataframe_to_rows(output_df_29, index=False, header=True):
-            sheet.append(r)
+        with stage("combined write", section="Remitter U2 RB Approved Transaction Amount"):
+            for r in dataframe_to_rows(output_df_29, index=False, header=True):
+                sheet.append(r)
 
         # Add blank rows (6 lines)
         for _ in range(6):
@@ -417,7 +744,8 @@ def process_combined_output(file_path, output_file):
         # Remitter U3 Approved Transaction Amount
         results_30 = []
         for sheet_name in excel_sheets:
-            df = pd.read_excel(file_path, sheet_name=sheet_name)
+            with stage("combined re-read", section="Remitter U3 Approved Transaction Amount", sheet=sheet_name):
+                df = pd.read_excel(file_path, sheet_name=sheet_name)
             if not all(col in df.columns for col in ['Description', 'No of Txns', 'Debit', 'Credit']):
                 continue
             filtered_df = df[df['Description'].str.startswith('Remitter', na=False) &
@@ -431,8 +759,9 @@ def process_combined_output(file_path, output_file):
                     'Credit': filtered_df['Credit'].sum()
                 })
         output_df_30 = pd.DataFrame(results_30)
-        for r in dataframe_to_rows(output_df_30, index=False, header=True):
-            sheet.append(r)
+        with stage("combined write", section="Remitter U3 Approved Transaction Amount"):
+            for r in dataframe_to_rows(output_df_30, index=False, header=True):
+                sheet.append(r)
 
         # Add blank rows (6 lines)
         for _ in range(6):
@@ -441,7 +770,8 @@ def process_combined_output(file_path, output_file):
         # Remitter U3 RB Approved Transaction Amount
         results_31 = []
         for sheet_name in excel_sheets:
-            df = pd.read_excel(file_path, sheet_name=sheet_name)
+            with stage("combined re-read", section="Remitter U3 RB Approved Transaction Amount", sheet=sheet_name):
+                df = pd.read_excel(file_path, sheet_name=sheet_name)
             if not all(col in df.columns for col in ['Description', 'No of Txns', 'Debit', 'Credit']):
                 continue
             filtered_df = df[df['Description'].str.startswith('Remitter', na=False) &
@@ -455,8 +785,9 @@ def process_combined_output(file_path, output_file):
                     'Credit': filtered_df['Credit'].sum()
                 })
         output_df_31 = pd.DataFrame(results_31)
-        for r in dataframe_to_rows(output_df_31, index=False, header=True):
-            sheet.append(r)
+        with stage("combined write", section="Remitter U3 RB Approved Transaction Amount"):
+            for r in dataframe_to_rows(output_df_31, index=False, header=True):
+                sheet.append(r)
 
         # Add blank rows (6 lines)
         for _ in range(6):
@@ -466,7 +797,8 @@ def process_combined_output(file_path, output_file):
         results_3 = []
         difference_dict = {}  # To store differences for later use
         for sheet_name in excel_sheets:
-            df = pd.read_excel(file_path, sheet_name=sheet_name)
+            with stage("combined re-read", section="Net Adjusted Amount", sheet=sheet_name):
+                df = pd.read_excel(file_path, sheet_name=sheet_name)
 
             # Filter for 'Net Adjusted Amount' rows
             filtered_row = df[df['Description'] == 'Net Adjusted Amount'].copy()
@@ -480,8 +812,9 @@ def process_combined_output(file_path, output_file):
         if results_3:
             output_df_3 = pd.concat(results_3, ignore_index=True)
             output_df_3 = output_df_3[['Cycle', 'Description', 'No of Txns', 'Debit', 'Credit', 'difference_debit_credit']]
-            for r in dataframe_to_rows(output_df_3, index=False, header=True):
-                sheet.append(r)
+            with stage("combined write", section="Net Adjusted Amount"):
+                for r in dataframe_to_rows(output_df_3, index=False, header=True):
+                    sheet.append(r)
 
         # Add blank rows (6 lines)
         for _ in range(6):
@@ -490,7 +823,8 @@ def process_combined_output(file_path, output_file):
         # Beneficiary/Remitter Sub Totals and Settlement Amount
         results_2 = []
         for sheet_name in excel_sheets:
-            df = pd.read_excel(file_path, sheet_name=sheet_name)
+            with stage("combined re-read", section="Sub Totals and Settlement Amount", sheet=sheet_name):
+                df = pd.read_excel(file_path, sheet_name=sheet_name)
             df.columns = [col.strip() for col in df.columns]
 
             filtered_row = df[df['Description'] == 'Beneficiary / Remitter Sub Totals']
@@ -510,8 +844,9 @@ def process_combined_output(file_path, output_file):
             results_2.append([sheet_name, debit, credit, settlement_amount])
 
         output_df_code2 = pd.DataFrame(results_2, columns=['Beneficiary / Remitter Sub Totals', 'DR (Amount)', 'CR (Amount)', 'NTSL Settlement Amount'])
-        for r in dataframe_to_rows(output_df_code2, index=False, header=True):
-            sheet.append(r)
+        with stage("combined write", section="Sub Totals and Settlement Amount"):
+            for r in dataframe_to_rows(output_df_code2, index=False, header=True):
+                sheet.append(r)
 
         # Add blank rows (6 lines)
         for _ in range(6):
@@ -520,7 +855,8 @@ def process_combined_output(file_path, output_file):
         # Final Settlement Amount with difference calculation
         results_code3 = pd.DataFrame(columns=['Final Settlement Amount', 'DR(Amount)', 'CR(Amount)', 'Difference In Settlement'])
         for sheet_name in excel_sheets:
-            df = pd.read_excel(file_path, sheet_name=sheet_name)
+            with stage("combined re-read", section="Final Settlement Amount", sheet=sheet_name):
+                df = pd.read_excel(file_path, sheet_name=sheet_name)
             df.columns = df.columns.str.strip()
 
             # Extract relevant rows
@@ -550,9 +886,169 @@ def process_combined_output(file_path, output_file):
                 })], ignore_index=True)
 
         # Write to Excel
-        for r in dataframe_to_rows(results_code3, index=False, header=True):
+        with stage("combined write", section="Final Settlement Amount"):
+            for r in dataframe_to_rows(results_code3, index=False, header=True):
+                sheet.append(r)
+
+
+        st.success(f"Final combined output saved to {output_file}")
+
+# Beneficiary/Remitter transaction amount sections written after the first block of
+# the combined output, in sheet order: (description prefix, description suffix, label)
+combined_amount_sections = [
+    ("Beneficiary", "U2 Approved Transaction Amount", "Beneficiary U2 Approved Transaction Amount"),
+    ("Beneficiary", "U2 RB Approved Transaction Amount", "Beneficiary U2 RB Approved Transaction Amount"),
+    ("Beneficiary", "U3 Approved Transaction Amount", "Beneficiary U3 Approved Transaction Amount"),
+    ("Beneficiary", "U3 RB Approved Transaction Amount", "Beneficiary U3 RB Approved Transaction Amount"),
+    ("Remitter", "Transaction Amount", "Remitter Approved Transaction Amount"),
+    ("Remitter", "U2 Approved Transaction Amount", "Remitter U2 Approved Transaction Amount"),
+    ("Remitter", "U2 RB Approved Transaction Amount", "Remitter U2 RB Approved Transaction Amount"),
+    ("Remitter", "U3 Approved Transaction Amount", "Remitter U3 Approved Transaction Amount"),
+    ("Remitter", "U3 RB Approved Transaction Amount", "Remitter U3 RB Approved Transaction Amount"),
+]
+
+def process_combined_output_fast(file_path, output_file):
+    # Same layout as process_combined_output, but every sheet is read once up front
+    # instead of once per section
+    with stage("combined read all sheets"):
+        sheets = pd.read_excel(file_path, sheet_name=None)
+    excel_sheets = list(sheets.keys())
+    required_columns = ['Description', 'No of Txns', 'Debit', 'Credit']
+
+    with excel_writer(output_file) as writer:
+        # Beneficiary Approved Transaction Amount U3
+        results_1 = []
+        progress_bar = st.progress(0)
+        total_sheets = len(excel_sheets)
+
+        for i, sheet_name in enumerate(excel_sheets):
+            progress_bar.progress((i + 1) / total_sheets)
+            df = sheets[sheet_name]
+            filtered_rows = df[df['Description'].str.startswith('Beneficiary', na=False) &
+                               (df['Description'].str.endswith('Approved Transaction Amount', na=False) |
+                                df['Description'].str.endswith('U3 RB Approved Transaction Amount', na=False))]
+            summed_row = filtered_rows[['No of Txns', 'Debit', 'Credit']].sum()
+            results_1.append({
+                'Cycle': sheet_name,
+                'Description': 'Beneficiary Approved Transaction Amount U3',
+                'No of Txns': summed_row['No of Txns'],
+                'Debit': summed_row['Debit'],
+                'Credit': summed_row['Credit']
+            })
+
+        output_df_1 = pd.DataFrame(results_1)
+        output_df_1.to_excel(writer, index=False, sheet_name="Combined", startrow=0)
+
+        workbook = writer.book
+        sheet = workbook["Combined"]
+
+        for _ in range(6):
+            sheet.append([])
+
+        # Transaction amount sections, skipping sheets without the required columns
+        valid_sheets = [name for name in excel_sheets
+                        if all(col in sheets[name].columns for col in required_columns)]
+        for start_condition, end_condition, label in combined_amount_sections:
+            results = []
+            for sheet_name in valid_sheets:
+                df = sheets[sheet_name]
+                filtered_df = df[df['Description'].str.startswith(start_condition, na=False) &
+                                 df['Description'].str.endswith(end_condition, na=False)]
+                if not filtered_df.empty:
+                    results.append({
+                        'Cycle': sheet_name,
+                        'Description': label,
+                        'No of Txns': filtered_df['No of Txns'].sum(),
+                        'Debit': filtered_df['Debit'].sum(),
+                        'Credit': filtered_df['Credit'].sum()
+                    })
+            for r in dataframe_to_rows(pd.DataFrame(results), index=False, header=True):
+                sheet.append(r)
+
+            for _ in range(6):
+                sheet.append([])
+
+        # Net Adjusted Amount with difference calculation
+        results_3 = []
+        difference_dict = {}
+        for sheet_name in excel_sheets:
+            df = sheets[sheet_name]
+            filtered_row = df[df['Description'] == 'Net Adjusted Amount'].copy()
+
+            if not filtered_row.empty:
+                filtered_row.loc[:, 'Cycle'] = sheet_name
+                filtered_row.loc[:, 'difference_debit_credit'] = filtered_row['Credit'] - filtered_row['Debit']
+                results_3.append(filtered_row)
+                difference_dict[sheet_name] = filtered_row.iloc[0]['difference_debit_credit']
+
+        if results_3:
+            output_df_3 = pd.concat(results_3, ignore_index=True)
+            output_df_3 = output_df_3[['Cycle', 'Description', 'No of Txns', 'Debit', 'Credit', 'difference_debit_credit']]
+            for r in dataframe_to_rows(output_df_3, index=False, header=True):
+                sheet.append(r)
+
+        for _ in range(6):
+            sheet.append([])
+
+        # The remaining sections match on stripped column names
+        stripped_sheets = {
+            sheet_name: df.set_axis([col.strip() for col in df.columns], axis=1)
+            for sheet_name, df in sheets.items()
+        }
+
+        # Beneficiary/Remitter Sub Totals and Settlement Amount
+        results_2 = []
+        for sheet_name in excel_sheets:
+            df = stripped_sheets[sheet_name]
+
+            filtered_row = df[df['Description'] == 'Beneficiary / Remitter Sub Totals']
+            if not filtered_row.empty:
+                debit = filtered_row['Debit'].sum()
+                credit = filtered_row['Credit'].sum()
+            else:
+                debit = 0
+                credit = 0
+
+            settlement_row = df[df['Description'] == 'Settlement Amount']
+            if not settlement_row.empty:
+                settlement_amount = settlement_row['Debit'].sum() + settlement_row['Credit'].sum()
+            else:
+                settlement_amount = 0
+
+            results_2.append([sheet_name, debit, credit, settlement_amount])
+
+        output_df_code2 = pd.DataFrame(results_2, columns=['Beneficiary / Remitter Sub Totals', 'DR (Amount)', 'CR (Amount)', 'NTSL Settlement Amount'])
+        for r in dataframe_to_rows(output_df_code2, index=False, header=True):
             sheet.append(r)
 
+        for _ in range(6):
+            sheet.append([])
+
+        # Final Settlement Amount with difference calculation
+        results_code3 = []
+        for sheet_name in excel_sheets:
+            df = stripped_sheets[sheet_name]
+
+            final_settlement_row = df[df['Description'].str.contains('Final Settlement Amount', case=False, na=False)]
+            settlement_row = df[df['Description'] == 'Settlement Amount']
+
+            if not final_settlement_row.empty and not settlement_row.empty:
+                final_debit = final_settlement_row.iloc[0]['Debit'] if 'Debit' in final_settlement_row.columns else 0
+                final_credit = final_settlement_row.iloc[0]['Credit'] if 'Credit' in final_settlement_row.columns else 0
+                final_settlement_amount = final_debit - final_credit
+
+                settlement_debit = settlement_row.iloc[0]['Debit'] if 'Debit' in settlement_row.columns else 0
+                settlement_credit = settlement_row.iloc[0]['Credit'] if 'Credit' in settlement_row.columns else 0
+                ntsl_settlement_amount = settlement_debit - settlement_credit
+
+                difference_debit_credit = difference_dict.get(sheet_name, 0)
+                difference = (final_settlement_amount - ntsl_settlement_amount) + difference_debit_credit
+
+                results_code3.append([sheet_name, final_debit, final_credit, round(difference)])
+
+        output_df_code3 = pd.DataFrame(results_code3, columns=['Final Settlement Amount', 'DR(Amount)', 'CR(Amount)', 'Difference In Settlement'])
+        for r in dataframe_to_rows(output_df_code3, index=False, header=True):
+            sheet.append(r)
 
         st.success(f"Final combined output saved to {output_file}")
 
@@ -643,7 +1139,7 @@ def process_aggregated_output(file_path, output_file_path):
     beneficiary_aggregated = pd.concat([beneficiary_aggregated, beneficiary_sub_totals], ignore_index=True)
 
     # Write both results to the same Excel file with appropriate gaps
-    with pd.ExcelWriter(output_file_path, engine="openpyxl") as writer:
+    with excel_writer(output_file_path) as writer:
         # Add "Remitter" heading and data
         pd.DataFrame(["Remitter"]).to_excel(writer, sheet_name="Combined Data", index=False, header=False, startrow=0)
         remitter_data.to_excel(writer, sheet_name="Combined Data", index=False, startrow=1)
@@ -662,8 +1158,15 @@ def process_aggregated_output(file_path, output_file_path):
         pd.DataFrame(["Beneficiary Aggregated Data"]).to_excel(writer, sheet_name="Combined Data", index=False, header=False, startrow=aggregated_beneficiary_start_row)
         beneficiary_aggregated.to_excel(writer, sheet_name="Combined Data", index=False, startrow=aggregated_beneficiary_start_row + 1)
 
+    # Per-cycle figures for the rollup store, reusing the frames computed above
+    with stage("cycle_aggregates"):
+        cycle_aggregates = build_cycle_aggregates(sheets, remitter_data, beneficiary_data)
+
     st.success(f"Combined output saved to: {output_file_path}")
 
+    # Later steps reuse the loaded sheets instead of reading the workbook again
+    return sheets, cycle_aggregates
+
 def process_conditions(sheets, conditions, data_type):
     final_data = []
 
@@ -737,40 +1240,43 @@ def aggregate_sub_totals(sheets, data_type):
         f"Total {data_type}": [total_value]
     })
 
-def aggregate_all_cycles(sheets, data_type):
-    aggregated_results = {}
-
-    conditions = [
-       "U2 Approved Fee",
+# Fee descriptions summed across all cycles in the aggregated output
+aggregate_conditions = [
+    "U2 Approved Fee",
     "U2 Approved Fee Gst",
     "U2 Approved NPCI Switching Fee",
     "U2 Approved NPCI Switching Fee Gst",
     "U2 RB Approved NPCI Switching Fee",
-     "U2 RB Approved NPCI Switching Fee Gst",
-     "U3 RB Approved NPCI Switching Fee",
-     "U3 RB Approved NPCI Switching Fee Gst",
-     "U2 RB Approved Payer PSP Fee",
-     "U2 RB Approved Payer PSP Fee Gst",
-     "U3 RB Approved Payer PSP Fee",
+    "U2 RB Approved NPCI Switching Fee Gst",
+    "U3 RB Approved NPCI Switching Fee",
+    "U3 RB Approved NPCI Switching Fee Gst",
+    "U2 RB Approved Payer PSP Fee",
+    "U2 RB Approved Payer PSP Fee Gst",
+    "U3 RB Approved Payer PSP Fee",
     "U3 RB Approved Payer PSP Fee Gst",
-   "U2 Approved Payer PSP Fee",
-     "U2 Approved Payer PSP Fee Gst",
-     "U3 RB Approved Fee",
-     "U3 RB Approved Fee Gst",
-     "U3 Approved Fee",
-     "U3 Approved Fee Gst",
-     "U3 Approved NPCI Switching Fee",
-   "U3 Approved NPCI Switching Fee Gst",
+    "U2 Approved Payer PSP Fee",
+    "U2 Approved Payer PSP Fee Gst",
+    "U3 RB Approved Fee",
+    "U3 RB Approved Fee Gst",
+    "U3 Approved Fee",
+    "U3 Approved Fee Gst",
+    "U3 Approved NPCI Switching Fee",
+    "U3 Approved NPCI Switching Fee Gst",
     "U3 Approved Payer PSP Fee",
-     "U3 Approved Payer PSP Fee Gst",
-   "U2 RB Approved Fee",
+    "U3 Approved Payer PSP Fee Gst",
+    "U2 RB Approved Fee",
     "U2 RB Approved Fee Gst",
-       "U2 RB Approved Surcharge Fee",
+    "U2 RB Approved Surcharge Fee",
     "U2 Approved Surcharge Fee",
     "U2 Approved Surcharge Fee Gst",
-     "U3 Approved Surcharge Fee",
-     "U3 Approved Surcharge Fee Gst"
-    ]
+    "U3 Approved Surcharge Fee",
+    "U3 Approved Surcharge Fee Gst",
+]
+
+def aggregate_all_cycles(sheets, data_type):
+    aggregated_results = {}
+
+    conditions = aggregate_conditions
 
     for condition in conditions:
         total_txn = 0
@@ -794,6 +1300,403 @@ def aggregate_all_cycles(sheets, data_type):
 
     return aggregated_df
 
+# Local store of per-cycle aggregates, keyed by settlement date and cycle. It lives in the
+# user's data directory and is only created when something is first saved.
+aggregate_store_path = os.environ.get(
+    "NTSL_AGGREGATE_STORE",
+    os.path.join(os.path.expanduser("~"), ".ntsl", "ntsl_aggregates.sqlite")
+)
+
+def open_aggregate_store():
+    os.makedirs(os.path.dirname(os.path.abspath(aggregate_store_path)), exist_ok=True)
+    connection = sqlite3.connect(aggregate_store_path)
+    connection.execute("""
+        CREATE TABLE IF NOT EXISTS cycle_aggregates (
+            settlement_date TEXT NOT NULL,
+            cycle TEXT NOT NULL,
+            section TEXT NOT NULL,
+            metric TEXT NOT NULL,
+            value REAL,
+            PRIMARY KEY (settlement_date, cycle, section, metric)
+        )
+    """)
+    return connection
+
+def settlement_figures(df):
+    # Per-cycle settlement figures, selecting rows exactly as process_combined_output does
+    figures = {}
+
+    # Net Adjusted Amount: the first matching row feeds the settlement difference
+    difference_debit_credit = 0
+    net_adjusted = df[df['Description'] == 'Net Adjusted Amount']
+    if not net_adjusted.empty:
+        figures["Net Adjusted Debit"] = net_adjusted.iloc[0]['Debit']
+        figures["Net Adjusted Credit"] = net_adjusted.iloc[0]['Credit']
+        difference_debit_credit = net_adjusted.iloc[0]['Credit'] - net_adjusted.iloc[0]['Debit']
+        figures["Net Adjusted Difference"] = difference_debit_credit
+
+    df = df.set_axis([str(col).strip() for col in df.columns], axis=1)
+
+    # Sub totals and the NTSL settlement amount sum every matching row
+    sub_totals = df[df['Description'] == 'Beneficiary / Remitter Sub Totals']
+    figures["Sub Totals Debit"] = sub_totals['Debit'].sum()
+    figures["Sub Totals Credit"] = sub_totals['Credit'].sum()
+    settlement_row = df[df['Description'] == 'Settlement Amount']
+    figures["NTSL Settlement Amount"] = settlement_row['Debit'].sum() + settlement_row['Credit'].sum()
+
+    # Final settlement uses the first matching row of each, only when both are present
+    final_settlement_row = df[df['Description'].str.contains('Final Settlement Amount', case=False, na=False)]
+    if not final_settlement_row.empty and not settlement_row.empty:
+        final_debit = final_settlement_row.iloc[0]['Debit']
+        final_credit = final_settlement_row.iloc[0]['Credit']
+        ntsl_settlement_amount = settlement_row.iloc[0]['Debit'] - settlement_row.iloc[0]['Credit']
+        figures["Final Settlement Debit"] = final_debit
+        figures["Final Settlement Credit"] = final_credit
+        figures["Difference In Settlement"] = round((final_debit - final_credit - ntsl_settlement_amount) + difference_debit_credit)
+
+    return figures
+
+def build_cycle_aggregates(sheets, remitter_data, beneficiary_data):
+    # Long table of (Cycle, Section, Metric, Value) for every cycle; Cycle is the sheet name
+    frames = []
+
+    # Remitter/beneficiary condition totals, already computed per cycle by process_conditions
+    for section, data in [("Remitter", remitter_data), ("Beneficiary", beneficiary_data)]:
+        per_cycle = data[data["Cycle"] != "Total"]
+        long = per_cycle.melt(id_vars="Cycle", var_name="Metric", value_name="Value")
+        long.insert(1, "Section", section)
+        frames.append(long)
+
+    # Per-cycle equivalent of aggregate_all_cycles and aggregate_sub_totals: each condition is
+    # matched once against the rows of all cycles and summed by cycle
+    table = pd.concat(
+        [df.loc[df['Description'].notna(), ['Description', 'No of Txns', 'Debit', 'Credit']].assign(Cycle=sheet_name)
+         for sheet_name, df in sheets.items()],
+        ignore_index=True
+    )
+    description = table['Description'].astype(str)
+    cycles = list(sheets.keys())
+    matches = [(condition, description.str.endswith(condition)) for condition in aggregate_conditions]
+    matches.append(("Beneficiary / Remitter Sub Totals", description.str.contains("Beneficiary / Remitter Sub Totals", regex=False)))
+
+    for label, mask in matches:
+        sums = table[mask].groupby('Cycle')[['No of Txns', 'Debit', 'Credit']].sum().reindex(cycles, fill_value=0)
+        for section, data_type in [("Remitter Aggregated", "Debit"), ("Beneficiary Aggregated", "Credit")]:
+            frames.append(pd.DataFrame({"Cycle": cycles, "Section": section,
+                                        "Metric": f"{label} Total Txns", "Value": sums['No of Txns'].values}))
+            frames.append(pd.DataFrame({"Cycle": cycles, "Section": section,
+                                        "Metric": f"{label} Total {data_type}", "Value": sums[data_type].values}))
+
+    for sheet_name, df in sheets.items():
+        figures = settlement_figures(df)
+        frames.append(pd.DataFrame({"Cycle": sheet_name, "Section": "Settlement",
+                                    "Metric": list(figures.keys()), "Value": list(figures.values())}))
+
+    return pd.concat(frames, ignore_index=True)
+
+def save_cycle_aggregates(cycle_aggregates, settlement_date):
+    date_key = str(settlement_date)
+    rows = [(date_key, cycle, section, metric, float(value))
+            for cycle, section, metric, value in cycle_aggregates[["Cycle", "Section", "Metric", "Value"]].itertuples(index=False)]
+    cycles = [(date_key, cycle) for cycle in cycle_aggregates["Cycle"].unique()]
+    connection = open_aggregate_store()
+    try:
+        with connection:
+            # Replace only the cycles being saved, so metrics a reprocessed cycle no longer
+            # has are cleared and other cycles stored for the date are kept
+            connection.executemany("DELETE FROM cycle_aggregates WHERE settlement_date = ? AND cycle = ?", cycles)
+            connection.executemany("""
+                INSERT INTO cycle_aggregates (settlement_date, cycle, section, metric, value)
+                VALUES (?, ?, ?, ?, ?)
+            """, rows)
+    finally:
+        connection.close()
+
+def show_save_aggregates(cycle_aggregates):
+    st.subheader("Save to Rollup Store")
+    settlement_date = st.date_input("Settlement date of this ZIP", value=None, key="store_settlement_date")
+    if settlement_date is None:
+        st.info("Pick the settlement date of this ZIP to save its cycle aggregates for rollups.")
+        return
+
+    if st.button("Save cycle aggregates"):
+        save_cycle_aggregates(cycle_aggregates, settlement_date)
+        st.success(f"Saved {cycle_aggregates['Cycle'].nunique()} cycles for {settlement_date}, "
+                   f"replacing any earlier figures for the same cycles.")
+
+def load_rollup(start_date, end_date):
+    # Sum the stored per-cycle aggregates over a settlement date range
+    if not os.path.exists(aggregate_store_path):
+        return pd.DataFrame(columns=["Section", "Metric", "Days", "Cycles", "Total"])
+    connection = open_aggregate_store()
+    try:
+        return pd.read_sql_query("""
+            SELECT section AS Section, metric AS Metric,
+                   COUNT(DISTINCT settlement_date) AS Days,
+                   COUNT(DISTINCT settlement_date || '/' || cycle) AS Cycles,
+                   SUM(value) AS Total
+            FROM cycle_aggregates
+            WHERE settlement_date BETWEEN ? AND ?
+            GROUP BY section, metric
+            ORDER BY section, metric
+        """, connection, params=(str(start_date), str(end_date)))
+    finally:
+        connection.close()
+
+def show_rollup_report():
+    st.header("Rollup Report")
+    date_range = st.date_input("Settlement date range", value=(date.today().replace(day=1), date.today()))
+    if not isinstance(date_range, (tuple, list)) or len(date_range) != 2:
+        return
+
+    rollup = load_rollup(*date_range)
+    if rollup.empty:
+        st.info("No stored cycles in this date range.")
+        return
+
+    st.dataframe(rollup)
+    output = BytesIO()
+    rollup.to_excel(output, sheet_name="Rollup", index=False, engine="openpyxl")
+    st.download_button(
+        label="Download Rollup Report",
+        data=output.getvalue(),
+        file_name=f"rollup_{date_range[0]}_{date_range[1]}.xlsx",
+        mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+    )
+
+# Splits a cleaned description into U2/U3 (RB) type and fee type, e.g.
+# "Remitter U2 RB Approved NPCI Switching Fee Gst" -> U2 RB / NPCI Switching Fee Gst
+description_pattern = r"\b(U[23](?: RB)?)\s+Approved\s+(.+)$"
+explorer_filters = ["Cycle", "Side", "Type", "Fee Type"]
+
+def build_explorer_table(sheets):
+    frames = []
+    for sheet_name, df in sheets.items():
+        df = df.set_axis([str(col).strip() for col in df.columns], axis=1)
+        if not all(col in df.columns for col in ['Description', 'No of Txns', 'Debit', 'Credit']):
+            continue
+        frame = df[['Description', 'No of Txns', 'Debit', 'Credit']].copy()
+        frame.insert(0, 'Cycle', sheet_name)
+        frames.append(frame)
+
+    if not frames:
+        table = pd.DataFrame(columns=['Cycle', 'Description', 'No of Txns', 'Debit', 'Credit'])
+    else:
+        table = pd.concat(frames, ignore_index=True)
+    table = table[table['Description'].notna()].reset_index(drop=True)
+    table['Description'] = table['Description'].astype(str)
+    for column in ['No of Txns', 'Debit', 'Credit']:
+        table[column] = pd.to_numeric(table[column], errors='coerce').fillna(0)
+
+    parts = table['Description'].str.extract(description_pattern)
+    # "Beneficiary / Remitter Sub Totals" covers both sides, so it gets a side of its own
+    # rather than being counted with the Beneficiary line items
+    table['Side'] = table['Description'].str.extract(r"^(Beneficiary|Remitter)\b(?!\s*/)")[0].fillna('Other')
+    table.loc[table['Description'].str.contains('Beneficiary / Remitter Sub Totals', regex=False), 'Side'] = 'Sub Totals'
+    table['Type'] = parts[0].fillna('Other')
+    table['Fee Type'] = parts[1].str.replace(r"\bGST$", "Gst", regex=True).fillna('Other')
+
+    for column in explorer_filters:
+        table[column] = table[column].astype('category')
+
+    # Row positions for every value of every filter column, so filtering is set intersection
+    indexes = {column: table.groupby(column, observed=True).indices for column in explorer_filters}
+    return {"table": table, "indexes": indexes}
+
+def filter_explorer_table(explorer, selections):
+    table = explorer["table"]
+    mask = np.ones(len(table), dtype=bool)
+    for column, values in selections.items():
+        if not values:
+            continue
+        column_mask = np.zeros(len(table), dtype=bool)
+        for value in values:
+            column_mask[explorer["indexes"][column].get(value, [])] = True
+        mask &= column_mask
+    return table[mask]
+
+def show_data_explorer(explorer):
+    st.header("Explore Processed Data")
+    table = explorer["table"]
+    if table.empty:
+        st.info("No rows with Description, No of Txns, Debit and Credit columns were found.")
+        return
+
+    selections = {}
+    filter_columns = st.columns(len(explorer_filters))
+    for column, container in zip(explorer_filters, filter_columns):
+        with container:
+            selections[column] = st.multiselect(column, list(table[column].cat.categories))
+
+    filtered = filter_explorer_table(explorer, selections)
+    st.write(f"{len(filtered)} of {len(table)} rows")
+
+    pivot_rows = st.selectbox("Pivot rows", explorer_filters + ["Description"], index=0)
+    pivot_columns = st.selectbox("Pivot columns", ["(none)"] + explorer_filters, index=0)
+    pivot_value = st.selectbox("Value", ['Debit', 'Credit', 'No of Txns'], index=0)
+
+    if pivot_columns == "(none)" or pivot_columns == pivot_rows:
+        pivot = filtered.groupby(pivot_rows, observed=True)[pivot_value].sum().to_frame()
+    else:
+        pivot = filtered.pivot_table(index=pivot_rows, columns=pivot_columns, values=pivot_value,
+                                     aggfunc='sum', fill_value=0, observed=True)
+    st.dataframe(pivot)
+
+    with st.expander("Matching rows", expanded=False):
+        st.dataframe(filtered)
+
+# Optimized engines, keyed by output. Each entry names the reference and optimized
+# implementations, the numeric tolerance allowed per cell, and any known layout shift of
+# the optimized workbook (its cell for reference cell (row, col) is at
+# (row + row_offset, col + col_offset)).
+# Set NTSL_FAST_ENGINES to a comma-separated list of keys (or "all") to use the optimized
+# implementation for the real output, and NTSL_SHADOW_MODE=1 to run both and compare them.
+engines = {
+    "combined": {
+        "reference": process_combined_output,
+        "optimized": process_combined_output_fast,
+        "tolerance": 0.005,
+        "row_offset": 0,
+        "col_offset": 0,
+    },
+}
+
+def enabled_fast_engines():
+    names = [name.strip() for name in os.environ.get("NTSL_FAST_ENGINES", "").split(",") if name.strip()]
+    if "all" in names:
+        return set(engines)
+    return {name for name in names if name in engines}
+
+def resolve_engine(name):
+    engine = engines[name]
+    return engine["optimized"] if name in enabled_fast_engines() else engine["reference"]
+
+def shadow_mode_enabled():
+    return os.environ.get("NTSL_SHADOW_MODE", "").lower() in ("1", "true", "yes")
+
+def cells_match(reference_value, candidate_value, tolerance):
+    if reference_value == candidate_value:
+        return True
+    # Blank cells may come back as None or as an empty string
+    if reference_value in (None, "") and candidate_value in (None, ""):
+        return True
+    numeric = (int, float)
+    if (isinstance(reference_value, numeric) and not isinstance(reference_value, bool) and
+            isinstance(candidate_value, numeric) and not isinstance(candidate_value, bool)):
+        if math.isnan(reference_value) and math.isnan(candidate_value):
+            return True
+        return math.isclose(reference_value, candidate_value, rel_tol=0, abs_tol=tolerance)
+    return False
+
+def compare_workbooks(reference_path, candidate_path, tolerance=0.005, row_offset=0, col_offset=0):
+    # Compare two workbooks cell by cell. The candidate cell for reference cell (row, col)
+    # is read from (row + row_offset, col + col_offset) of the sheet with the same name.
+    reference_book = openpyxl.load_workbook(reference_path, data_only=True)
+    candidate_book = openpyxl.load_workbook(candidate_path, data_only=True)
+    diffs = []
+
+    for sheet_name in reference_book.sheetnames:
+        if sheet_name not in candidate_book.sheetnames:
+            diffs.append({"sheet": sheet_name, "cell": None, "reference": "<sheet>", "candidate": None})
+            continue
+
+        reference_sheet = reference_book[sheet_name]
+        candidate_sheet = candidate_book[sheet_name]
+        max_row = max(reference_sheet.max_row, candidate_sheet.max_row - row_offset, 1)
+        max_col = max(reference_sheet.max_column, candidate_sheet.max_column - col_offset, 1)
+
+        for row in range(1, max_row + 1):
+            for col in range(1, max_col + 1):
+                reference_value = reference_sheet.cell(row=row, column=col).value
+                if row + row_offset < 1 or col + col_offset < 1:
+                    # A negative offset shifts this cell off the candidate sheet; only
+                    # non-blank reference cells there are differences
+                    if reference_value not in (None, ""):
+                        diffs.append({
+                            "sheet": sheet_name,
+                            "cell": f"{get_column_letter(col)}{row}",
+                            "reference": reference_value,
+                            "candidate": "<outside sheet>"
+                        })
+                    continue
+                candidate_value = candidate_sheet.cell(row=row + row_offset, column=col + col_offset).value
+                if not cells_match(reference_value, candidate_value, tolerance):
+                    diffs.append({
+                        "sheet": sheet_name,
+                        "cell": f"{get_column_letter(col)}{row}",
+                        "reference": reference_value,
+                        "candidate": candidate_value
+                    })
+
+    for sheet_name in candidate_book.sheetnames:
+        if sheet_name not in reference_book.sheetnames:
+            diffs.append({"sheet": sheet_name, "cell": None, "reference": None, "candidate": "<sheet>"})
+
+    return diffs
+
+def run_quietly(func, *args):
+    # Run an engine without leaving its progress bar and messages on the page
+    placeholder = st.empty()
+    with placeholder.container():
+        result = func(*args)
+    placeholder.empty()
+    return result
+
+def run_equivalence_check(name, input_path, produced_output=None, produced_seconds=None):
+    # Run the reference and optimized engines on the same input and compare their workbooks.
+    # produced_output is a workbook the active engine (see resolve_engine) already wrote for
+    # input_path; when given, only the other engine is run.
+    engine = engines[name]
+    outputs = {}
+    seconds = {}
+    if produced_output is not None:
+        active = "optimized" if name in enabled_fast_engines() else "reference"
+        outputs[active] = produced_output
+        seconds[active] = produced_seconds
+
+    with tempfile.TemporaryDirectory(prefix="ntsl_shadow_") as work_dir:
+        for role in ("reference", "optimized"):
+            if role in outputs:
+                continue
+            outputs[role] = os.path.join(work_dir, f"shadow_{name}_{role}.xlsx")
+            start = time.perf_counter()
+            run_quietly(engine[role], input_path, outputs[role])
+            seconds[role] = time.perf_counter() - start
+
+        diffs = compare_workbooks(outputs["reference"], outputs["optimized"], engine["tolerance"],
+                                  engine["row_offset"], engine["col_offset"])
+
+    reference_seconds = seconds["reference"]
+    candidate_seconds = seconds["optimized"]
+    return {
+        "engine": name,
+        "reference_seconds": reference_seconds,
+        "candidate_seconds": candidate_seconds,
+        "speedup": reference_seconds / candidate_seconds if reference_seconds and candidate_seconds else None,
+        "diffs": diffs
+    }
+
+def run_shadow_checks(input_path, produced):
+    # produced maps engine name to (output path, seconds) for outputs already written this run
+    reports = []
+    for name in engines:
+        produced_output, produced_seconds = produced.get(name, (None, None))
+        reports.append(run_equivalence_check(name, input_path, produced_output, produced_seconds))
+    return reports
+
+def show_shadow_report(reports):
+    with st.expander("Shadow comparison", expanded=False):
+        for report in reports:
+            speedup = f"{report['speedup']:.1f}x" if report["speedup"] else "n/a"
+            st.write(f"**{report['engine']}**: reference {report['reference_seconds']:.2f}s, "
+                     f"optimized {report['candidate_seconds']:.2f}s, "
+                     f"speedup {speedup}")
+            if report["diffs"]:
+                st.error(f"{len(report['diffs'])} cell(s) differ from the reference output.")
+                st.dataframe(pd.DataFrame(report["diffs"]).astype(str))
+            else:
+                st.success("Output matches the reference implementation.")
+
 if __name__ == "__main__":
     main()
 
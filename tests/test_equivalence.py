@@ -0,0 +1,89 @@
+import pytest
+
+pytest.importorskip("streamlit")
+pd = pytest.importorskip("pandas")
+openpyxl = pytest.importorskip("openpyxl")
+
+import App  # noqa: E402
+
+
+def cleaned_sheet(scale, include_remitter_u3=True):
+    rows = [
+        ("Beneficiary U2 Approved Transaction Amount", 10 * scale, 0, 1500.25 * scale),
+        ("Beneficiary U2 RB Approved Transaction Amount", 2 * scale, 0, 120.5 * scale),
+        ("Beneficiary U3 Approved Transaction Amount", 4 * scale, 0, 410.75 * scale),
+        ("Beneficiary U3 RB Approved Transaction Amount", 1 * scale, 0, 99.99 * scale),
+        ("Remitter U2 Approved Transaction Amount", 7 * scale, 870.1 * scale, 0),
+        ("Remitter U2 RB Approved Transaction Amount", 3 * scale, 45.0 * scale, 0),
+        ("Remitter U3 RB Approved Transaction Amount", 2 * scale, 12.3 * scale, 0),
+        ("Remitter U2 Approved Fee", 7 * scale, 3.5 * scale, 0),
+        ("Beneficiary U2 Approved NPCI Switching Fee Gst", 10 * scale, 0, 0.45 * scale),
+        ("Net Adjusted Amount", 0, 15.0 * scale, 22.5 * scale),
+        ("Beneficiary / Remitter Sub Totals", 0, 930.9 * scale, 2131.49 * scale),
+        ("Settlement Amount", 0, 0, 1200.59 * scale),
+        ("Final Settlement Amount", 0, 0, 1193.09 * scale),
+        (None, None, None, None),
+    ]
+    if include_remitter_u3:
+        rows.insert(7, ("Remitter U3 Approved Transaction Amount", 5 * scale, 640.0 * scale, 0))
+    return pd.DataFrame(rows, columns=["Description", "No of Txns", "Debit", "Credit"])
+
+
+@pytest.fixture
+def cleaned_workbook(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.delenv("NTSL_FAST_ENGINES", raising=False)
+    path = tmp_path / "output_file.xlsx"
+    with pd.ExcelWriter(path, engine="openpyxl") as writer:
+        cleaned_sheet(1).to_excel(writer, sheet_name="sheet1", index=False)
+        cleaned_sheet(2, include_remitter_u3=False).to_excel(writer, sheet_name="sheet2", index=False)
+        cleaned_sheet(3).to_excel(writer, sheet_name="sheet3", index=False)
+    return str(path)
+
+
+def test_combined_fast_engine_matches_reference(cleaned_workbook):
+    report = App.run_equivalence_check("combined", cleaned_workbook)
+
+    assert report["diffs"] == []
+    assert report["reference_seconds"] > 0
+    assert report["candidate_seconds"] > 0
+
+
+def test_compare_workbooks_reports_cells_beyond_tolerance(cleaned_workbook, tmp_path):
+    reference_path = str(tmp_path / "reference.xlsx")
+    App.process_combined_output(cleaned_workbook, reference_path)
+
+    book = openpyxl.load_workbook(reference_path)
+    sheet = book["Combined"]
+    sheet["D2"] = sheet["D2"].value + 0.001
+    sheet["E2"] = sheet["E2"].value + 1
+    candidate_path = str(tmp_path / "candidate.xlsx")
+    book.save(candidate_path)
+
+    diffs = App.compare_workbooks(reference_path, candidate_path, tolerance=0.005)
+
+    assert [diff["cell"] for diff in diffs] == ["E2"]
+
+
+def test_compare_workbooks_applies_layout_offsets(tmp_path):
+    reference_path = str(tmp_path / "reference.xlsx")
+    reference = openpyxl.Workbook()
+    reference.active.title = "Combined"
+    reference["Combined"].append(["Title"])
+    reference["Combined"].append(["Cycle", "Debit"])
+    reference["Combined"].append(["sheet1", 10.5])
+    reference.save(reference_path)
+
+    # The candidate drops the leading title row
+    candidate_path = str(tmp_path / "candidate.xlsx")
+    candidate = openpyxl.Workbook()
+    candidate.active.title = "Combined"
+    candidate["Combined"].append(["Cycle", "Debit"])
+    candidate["Combined"].append(["sheet1", 10.5])
+    candidate.save(candidate_path)
+
+    diffs = App.compare_workbooks(reference_path, candidate_path, row_offset=-1)
+    assert diffs == [{"sheet": "Combined", "cell": "A1", "reference": "Title", "candidate": "<outside sheet>"}]
+
+    # Read the other way round, the candidate's extra leading row is skipped
+    assert App.compare_workbooks(candidate_path, reference_path, row_offset=1) == []
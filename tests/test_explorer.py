@@ -0,0 +1,60 @@
+import pytest
+
+pytest.importorskip("streamlit")
+pd = pytest.importorskip("pandas")
+
+import App  # noqa: E402
+
+
+def cleaned_sheet(rows):
+    return pd.DataFrame(rows, columns=["Description", "No of Txns", "Debit", "Credit"])
+
+
+@pytest.fixture
+def explorer():
+    sheets = {
+        "sheet1": cleaned_sheet([
+            ("Beneficiary U2 Approved Transaction Amount", 10, 0, 1000.0),
+            ("Remitter U2 RB Approved NPCI Switching Fee GST", 4, 1.8, 0),
+            ("Beneficiary / Remitter Sub Totals", 0, 500.0, 1000.0),
+            ("Net Adjusted Amount", 0, 15.0, 22.5),
+            (None, None, None, None),
+        ]),
+        "sheet2": cleaned_sheet([
+            ("Beneficiary U3 Approved Fee", 2, 0, 20.0),
+            ("Remitter U3 RB Approved Payer PSP Fee", 3, 9.0, 0),
+            ("Beneficiary / Remitter Sub Totals", 0, 9.0, 20.0),
+        ]),
+    }
+    return App.build_explorer_table(sheets)
+
+
+def test_derived_columns(explorer):
+    table = explorer["table"].set_index("Description")
+
+    assert len(table) == 7
+    assert table.loc["Beneficiary U2 Approved Transaction Amount", ["Side", "Type", "Fee Type"]].tolist() == \
+        ["Beneficiary", "U2", "Transaction Amount"]
+    assert table.loc["Remitter U2 RB Approved NPCI Switching Fee GST", ["Side", "Type", "Fee Type"]].tolist() == \
+        ["Remitter", "U2 RB", "NPCI Switching Fee Gst"]
+    assert table.loc["Net Adjusted Amount", ["Side", "Type", "Fee Type"]].tolist() == ["Other", "Other", "Other"]
+    assert set(table.loc["Beneficiary / Remitter Sub Totals", "Side"]) == {"Sub Totals"}
+
+
+def test_filter_by_side_excludes_combined_sub_totals(explorer):
+    filtered = App.filter_explorer_table(explorer, {"Side": ["Beneficiary"]})
+
+    assert sorted(filtered["Description"]) == [
+        "Beneficiary U2 Approved Transaction Amount",
+        "Beneficiary U3 Approved Fee",
+    ]
+    assert filtered["Credit"].sum() == 1020.0
+
+
+def test_filters_intersect_and_empty_selection_keeps_all_rows(explorer):
+    assert len(App.filter_explorer_table(explorer, {"Side": [], "Cycle": []})) == 7
+
+    filtered = App.filter_explorer_table(explorer, {"Cycle": ["sheet2"], "Type": ["U3 RB", "U2 RB"]})
+    assert filtered["Description"].tolist() == ["Remitter U3 RB Approved Payer PSP Fee"]
+
+    assert App.filter_explorer_table(explorer, {"Side": ["Remitter"], "Fee Type": ["Fee"]}).empty
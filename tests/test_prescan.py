@@ -0,0 +1,85 @@
+import zipfile
+from io import BytesIO
+
+import pytest
+
+pytest.importorskip("streamlit")
+pytest.importorskip("pandas")
+
+import App  # noqa: E402
+
+
+def build_zip(members, compression=zipfile.ZIP_STORED):
+    # members maps member name to its content
+    buffer = BytesIO()
+    with zipfile.ZipFile(buffer, "w", compression) as archive:
+        for name, content in members.items():
+            archive.writestr(name, content)
+    buffer.seek(0)
+    return zipfile.ZipFile(buffer)
+
+
+def prescan(members, compression=zipfile.ZIP_STORED):
+    with build_zip(members, compression) as zip_ref:
+        return App.prescan_zip(zip_ref)
+
+
+def test_members_within_limits_pass_with_total_size():
+    members, total_size, error = prescan({
+        "cycle1.xls": b"a" * 100,
+        "nested/cycle2.xls": b"b" * 250,
+        "readme.txt": b"c" * 10000,
+    })
+
+    assert error is None
+    assert [info.filename for info in members] == ["cycle1.xls", "nested/cycle2.xls"]
+    assert total_size == 350
+
+
+def test_rejects_too_many_members(monkeypatch):
+    monkeypatch.setattr(App, "max_zip_members", 2)
+
+    members, _, error = prescan({f"cycle{i}.xls": b"x" for i in range(3)})
+
+    assert members is None
+    assert "3 .xls files" in error
+
+
+def test_rejects_oversized_member(monkeypatch):
+    monkeypatch.setattr(App, "max_member_size", 1000)
+
+    members, _, error = prescan({"small.xls": b"a" * 10, "large.xls": b"b" * 1001})
+
+    assert members is None
+    assert error.startswith("large.xls")
+
+
+def test_rejects_total_size(monkeypatch):
+    monkeypatch.setattr(App, "max_total_size", 1000)
+
+    members, _, error = prescan({"cycle1.xls": b"a" * 600, "cycle2.xls": b"b" * 600})
+
+    assert members is None
+    assert "total" in error
+
+
+def test_rejects_high_compression_ratio(monkeypatch):
+    monkeypatch.setattr(App, "max_compression_ratio", 10)
+
+    members, _, error = prescan({"bomb.xls": b"\0" * 100000}, compression=zipfile.ZIP_DEFLATED)
+
+    assert members is None
+    assert error.startswith("bomb.xls has a compression ratio")
+
+
+@pytest.mark.parametrize("raw", ["inf", "nan", "-5", "0", "abc"])
+def test_env_number_falls_back_on_invalid_values(monkeypatch, raw):
+    monkeypatch.setenv("NTSL_TEST_LIMIT", raw)
+
+    assert App.env_number("NTSL_TEST_LIMIT", 50) == 50
+
+
+def test_env_number_accepts_fractions(monkeypatch):
+    monkeypatch.setenv("NTSL_TEST_LIMIT", "0.5")
+
+    assert App.env_number("NTSL_TEST_LIMIT", 50) == 0.5
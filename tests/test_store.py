@@ -0,0 +1,67 @@
+from datetime import date
+
+import pytest
+
+pytest.importorskip("streamlit")
+pd = pytest.importorskip("pandas")
+
+import App  # noqa: E402
+
+
+@pytest.fixture
+def store_path(tmp_path, monkeypatch):
+    path = str(tmp_path / "store" / "aggregates.sqlite")
+    monkeypatch.setattr(App, "aggregate_store_path", path)
+    return path
+
+
+def cycle_aggregates(values):
+    # values maps cycle to the Remitter "U2 Approved Fee Debit" figure
+    return pd.DataFrame({
+        "Cycle": list(values),
+        "Section": "Remitter",
+        "Metric": "U2 Approved Fee Debit",
+        "Value": list(values.values())
+    })
+
+
+def rollup_total(start_date, end_date):
+    rollup = App.load_rollup(start_date, end_date)
+    row = rollup[(rollup["Section"] == "Remitter") & (rollup["Metric"] == "U2 Approved Fee Debit")]
+    return row.iloc[0]["Cycles"], row.iloc[0]["Total"]
+
+
+def test_load_rollup_does_not_create_the_store(store_path):
+    rollup = App.load_rollup(date(2024, 10, 1), date(2024, 10, 31))
+
+    assert rollup.empty
+    assert not App.os.path.exists(store_path)
+
+
+def test_rollup_sums_cycles_within_the_date_range(store_path):
+    App.save_cycle_aggregates(cycle_aggregates({"A": 10.0, "B": 5.0}), date(2024, 10, 1))
+    App.save_cycle_aggregates(cycle_aggregates({"A": 7.0}), date(2024, 10, 2))
+    App.save_cycle_aggregates(cycle_aggregates({"A": 100.0}), date(2024, 11, 1))
+
+    assert rollup_total(date(2024, 10, 1), date(2024, 10, 31)) == (3, 22.0)
+    assert rollup_total(date(2024, 10, 2), date(2024, 11, 1)) == (2, 107.0)
+
+
+def test_saving_one_cycle_keeps_the_other_cycles_of_the_date(store_path):
+    App.save_cycle_aggregates(cycle_aggregates({"A": 10.0, "B": 5.0}), date(2024, 10, 1))
+    App.save_cycle_aggregates(cycle_aggregates({"B": 6.0}), date(2024, 10, 1))
+
+    assert rollup_total(date(2024, 10, 1), date(2024, 10, 1)) == (2, 16.0)
+
+
+def test_reprocessed_cycle_drops_metrics_it_no_longer_has(store_path):
+    first = pd.concat([
+        cycle_aggregates({"A": 10.0}),
+        pd.DataFrame({"Cycle": ["A"], "Section": ["Settlement"], "Metric": ["Final Settlement Debit"], "Value": [3.0]})
+    ], ignore_index=True)
+    App.save_cycle_aggregates(first, date(2024, 10, 1))
+    App.save_cycle_aggregates(cycle_aggregates({"A": 12.0}), date(2024, 10, 1))
+
+    rollup = App.load_rollup(date(2024, 10, 1), date(2024, 10, 1))
+    assert list(rollup["Metric"]) == ["U2 Approved Fee Debit"]
+    assert rollup.iloc[0]["Total"] == 12.0